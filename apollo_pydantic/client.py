@@ -5,97 +5,170 @@ import json
 import time
 from types import NoneType
 from typing import Any, Dict, List, Optional, Union
-from urllib.parse import quote, urlencode, urljoin
+from urllib.parse import quote, urlencode
 
 from httpx import AsyncClient
 from pydantic import HttpUrl
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from .logger import debug_logger
 
+# returned instead of the decoded body when it is identical to the previous one
+UNCHANGED = object()
+
+def json_dumps(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+
+def json_loads(data: Union[bytes, str]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 
 class ApolloClient:
     def __init__(self, config_server: Union[str, HttpUrl],
                  appid:str,
                  cluster:str='default',
-                 secret_key:Optional[str]=None):
+                 secret_key:Optional[str]=None,
+                 client:Optional[AsyncClient]=None):
         self.config_server = config_server
         self.appid = appid
         self.cluster = cluster
         self.secret_key = secret_key
-        self._client = None
+        # static url parts, built once instead of on every request
+        self._base = str(config_server).rstrip('/')
+        self._appid_q = quote(appid, safe='')
+        self._cluster_q = quote(cluster, safe='')
+        self._config_paths: Dict[str, str] = {}
+        # hash of the last applied body, and of the last fetched one waiting for `mark_applied`
+        self._body_hash: Dict[str, bytes] = {}
+        self._pending_hash: Dict[str, bytes] = {}
+        self._notification_path = f'/notifications/v2?appId={self._appid_q}&cluster={self._cluster_q}&notifications='
+        # keyed hmac prototype, copied per request to skip re-keying
+        self._hmac_proto = hmac.new(secret_key.encode(), b'', hashlib.sha1) if secret_key else None
+        # shared pooled client, injected by ApolloSettingsMetadata
+        self._client = client
+        self._own_client = False
 
     async def __aenter__(self):
-        self._client = AsyncClient()
+        if self._client is None or self._client.is_closed:
+            self._client = AsyncClient()
+            self._own_client = True
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self._client.aclose()
-        self._client = None
+        if self._own_client:
+            await self._client.aclose()
+            self._client = None
+            self._own_client = False
 
-    async def _http_get(self, path: str, timeout: float=5):
-        url = urljoin(self.config_server, path)
+    async def _http_get(self, path: str, timeout: float=5, cache_key: Optional[str]=None):
+        url = f'{self._base}{path}'
         debug_logger.debug(f'GET {url}')
-        if self._client:
-            res = await self._client.get(url, follow_redirects=True, headers=self.headers(path), timeout=timeout)
-        else:
-            async with AsyncClient() as client:
-                res = await client.get(url, follow_redirects=True, headers=self.headers(path), timeout=timeout)
+        if self._client is None:
+            raise RuntimeError('http client is not set, use `async with ApolloClient(...)` or pass `client`')
+        res = await self._client.get(url, follow_redirects=True, headers=self.headers(path), timeout=timeout)
         if res.status_code == 304:
             return None
-        return res.json()
+        if cache_key is None or not res.is_success:
+            return json_loads(res.content)
+        h = hashlib.sha1(res.content).digest()
+        if self._body_hash.get(cache_key) == h:
+            return UNCHANGED
+        data = json_loads(res.content)
+        self._pending_hash[cache_key] = h
+        return data
 
     def _parse_path(self, path, params):
         if params:
             path = f'{path}?{urlencode(params)}'
         return path
 
-    @staticmethod
-    def signature(timestamp: str, uri: str, secret: str):
-        string_to_sign = timestamp + '\n' + uri
-        hmac_code = hmac.new(secret.encode(), string_to_sign.encode(), hashlib.sha1).digest()
-        return base64.b64encode(hmac_code).decode()
+    def signature(self, timestamp: str, uri: str):
+        h = self._hmac_proto.copy()
+        h.update(timestamp.encode())
+        h.update(b'\n')
+        h.update(uri.encode())
+        return base64.b64encode(h.digest()).decode('ascii')
 
     def headers(self, path: str, params=None):
         if self.secret_key:
             path = self._parse_path(path, params)
             timestamp = str(int(time.time()*1000))
-            sig = self.signature(timestamp, path, self.secret_key)
+            sig = self.signature(timestamp, path)
             return {
                 'Authorization': f'Apollo {self.appid}:{sig}',
                 'Timestamp': timestamp,
             }
         return {}
 
+    def _config_path(self, namespace: str):
+        path = self._config_paths.get(namespace)
+        if path is None:
+            path = self._config_paths[namespace] = f'/configs/{self._appid_q}/{self._cluster_q}/{quote(namespace, safe="")}'
+        return path
+
     async def cached_config(self, namespace:str, format: str='json'):
         if format == 'json':
-            path = f'/configfiles/json/{self.appid}/{self.cluster}/{namespace}'
+            path = f'/configfiles/json/{self._appid_q}/{self._cluster_q}/{quote(namespace, safe="")}'
         else:
-            path = f'/configfiles/{self.appid}/{self.cluster}/{namespace}'
+            path = f'/configfiles/{self._appid_q}/{self._cluster_q}/{quote(namespace, safe="")}'
         return await self._http_get(path, timeout=5)
 
     async def uncached_config(self,
                                namespace:str,
                                release_key: Optional[str]=None,
                                messages: Union[str, Dict[str, Any], NoneType]=None,
-                               label: Optional[str]=None):
+                               label: Optional[str]=None,
+                               skip_unchanged: bool=False):
+        """
+            skip_unchanged: return `UNCHANGED` instead of the config when the body equals the last one
+                            confirmed by `mark_applied`
+        """
         params = {}
         if release_key:
             params['releaseKey'] = release_key
         if messages:
             if not isinstance(messages, str):
-                messages = json.dumps(messages)
+                messages = json_dumps(messages)
             params['messages'] = messages
         if label:
             params['label'] = label
-        path = f'/configs/{self.appid}/{self.cluster}/{namespace}'
-        path = self._parse_path(path, params)
-        return await self._http_get(path)
+        config_path = self._config_path(namespace)
+        path = self._parse_path(config_path, params)
+        return await self._http_get(path, cache_key=config_path if skip_unchanged else None)
+
+    def mark_applied(self, namespace: str):
+        """
+            remember the last body fetched with skip_unchanged as applied, identical bodies are skipped afterwards
+        """
+        config_path = self._config_path(namespace)
+        if (h := self._pending_hash.pop(config_path, None)) is not None:
+            self._body_hash[config_path] = h
+
+    def forget(self, namespace: str):
+        config_path = self._config_paths.pop(namespace, None)
+        if config_path is not None:
+            self._body_hash.pop(config_path, None)
+            self._pending_hash.pop(config_path, None)
+
+    @staticmethod
+    def encode_notifications(notifications: List[Dict[str, Union[str, int]]]) -> str:
+        return quote(json_dumps(notifications))
 
-    async def notification(self, notifications: List[Dict[str, Union[str, int]]]):
+    async def notification(self, notifications: Union[str, List[Dict[str, Union[str, int]]]]):
         """
             notifications: [{"namespaceName": "application", "notificationId": 100}, {"namespaceName": "FX.apollo", "notificationId": 200}]
+            or the result of `encode_notifications` when the caller caches it
         """
-        notifications = json.dumps(notifications)
-        notifications = quote(notifications)
-        path = f'/notifications/v2?appId={self.appid}&cluster={self.cluster}&notifications={notifications}'
+        if not isinstance(notifications, str):
+            notifications = self.encode_notifications(notifications)
+        path = f'{self._notification_path}{notifications}'
         return await self._http_get(path, timeout=100)
\ No newline at end of file
@@ -1,19 +1,31 @@
 import asyncio
-import json
-import os
 import re
+import threading
 from collections import defaultdict
-from functools import lru_cache
-from typing import Any, Dict, List, Optional, Set, Tuple, Type, Union
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from typing import (Any, Dict, FrozenSet, List, Optional, Set, Tuple, Type,
+                    Union)
+from weakref import WeakKeyDictionary, WeakValueDictionary, finalize, ref
 
 import httpx
 from pydantic import (AliasChoices, AliasPath, HttpUrl, SecretStr,
                       ValidationError, model_validator)
-from pydantic_settings import BaseSettings, SettingsConfigDict
+from pydantic_settings import (BaseSettings, EnvSettingsSource,
+                               PydanticBaseSettingsSource, SettingsConfigDict)
+
+try:
+    from pydantic_settings.sources.utils import parse_env_vars
+except ImportError:
+    try:
+        from pydantic_settings.sources import parse_env_vars
+    except ImportError:
+        # pydantic-settings < 2.2 has no env_ignore_empty / env_parse_none_str
+        parse_env_vars = None
 
 from apollo_pydantic.logger import debug_logger, logger
 
-from .client import ApolloClient
+from .client import UNCHANGED, ApolloClient, json_dumps
 
 
 class ApolloSettingsConfigDict(SettingsConfigDict):
@@ -24,7 +36,12 @@ class ApolloSettingsConfigDict(SettingsConfigDict):
 
 ClientKey = Tuple[Union[HttpUrl, str], str, str]
 
-ARRAY_RE = re.compile(r'^(?P<name>[\w\-_\.]+)\[(?P<index>\d+)\]$')
+_instance_lock = threading.Lock()
+
+ARRAY_RE = re.compile(r'(?P<name>[\w\-_\.]+)\[(?P<index>\d+)\]')
+
+# (env name, array index) for an apollo key, index is None for scalar keys
+KeyTransform = Tuple[str, Optional[int]]
 
 def _add_alias_to_set(aliases: Set[str], alias: Union[str, AliasChoices, AliasPath]):
     if isinstance(alias, str):
@@ -39,28 +56,99 @@ def _add_alias_to_set(aliases: Set[str], alias: Union[str, AliasChoices, AliasPa
                 aliases.add(choice.path[0])
     return aliases
 
+class ApolloEnvSettingsSource(EnvSettingsSource):
+    """
+        env source which reads the config pulled from apollo instead of os.environ
+    """
+    def _load_env_vars(self):
+        env_vars = self.settings_cls.__apollo_env__
+        if parse_env_vars is not None:
+            return parse_env_vars(env_vars, self.case_sensitive, self.env_ignore_empty, self.env_parse_none_str)
+        if self.case_sensitive:
+            return env_vars
+        return {k.lower(): v for k, v in env_vars.items()}
+
+def _add_apollo_source(settings_cls: Type[BaseSettings],
+                       sources: Tuple[PydanticBaseSettingsSource, ...],
+                       init_settings: PydanticBaseSettingsSource,
+                       env_settings: PydanticBaseSettingsSource):
+    sources = tuple(sources)
+    if any(isinstance(source, ApolloEnvSettingsSource) for source in sources):
+        return sources
+    # apollo config takes precedence over the process environment
+    if env_settings in sources:
+        index = sources.index(env_settings)
+    elif init_settings in sources:
+        index = sources.index(init_settings) + 1
+    else:
+        index = 0
+    return sources[:index] + (ApolloEnvSettingsSource(settings_cls),) + sources[index:]
+
+def _with_apollo_source(func):
+    """
+        wrap a user defined settings_customise_sources so the apollo source is still injected
+    """
+    @wraps(func)
+    def settings_customise_sources(cls,
+                                   settings_cls: Type[BaseSettings],
+                                   init_settings: PydanticBaseSettingsSource,
+                                   env_settings: PydanticBaseSettingsSource,
+                                   dotenv_settings: PydanticBaseSettingsSource,
+                                   file_secret_settings: PydanticBaseSettingsSource):
+        sources = func(cls, settings_cls, init_settings, env_settings, dotenv_settings, file_secret_settings)
+        return _add_apollo_source(settings_cls, sources, init_settings, env_settings)
+    return classmethod(settings_customise_sources)
+
 class ApolloSettingsMetadata:
-    def __init__(self, onerror_retry_interval: int = 10, onerror_resume: bool = True):
+    def __init__(self, onerror_retry_interval: int = 10, onerror_resume: bool = True, max_concurrent_fetches: int = 8):
         self._clients: Dict[ClientKey, ApolloClient] = {}
-        self._registered: Dict[ApolloClient, Dict[str, Type["ApolloSettings"]]] = defaultdict(dict)
-        self._notifications: Dict[ApolloClient, List[Dict[str, Union[str, int]]]] = defaultdict(list)
+        # settings classes are held weakly so dynamically created ones can be collected
+        self._registered: Dict[ApolloClient, WeakValueDictionary[str, Type["ApolloSettings"]]] = \
+            defaultdict(WeakValueDictionary)
+        self._client_by_cls: WeakKeyDictionary[Type["ApolloSettings"], ApolloClient] = WeakKeyDictionary()
+        self._namespace_by_cls: WeakKeyDictionary[Type["ApolloSettings"], str] = WeakKeyDictionary()
+        self._aliases: WeakKeyDictionary[Type["ApolloSettings"], FrozenSet[str]] = WeakKeyDictionary()
+        # namespace -> {'namespaceName': ..., 'notificationId': ...}
+        self._notifications: Dict[ApolloClient, Dict[str, Dict[str, Union[str, int]]]] = defaultdict(dict)
+        # url-encoded notifications, re-encoded only when a notificationId changes
+        self._notifications_encoded: Dict[ApolloClient, str] = {}
+        self._notifications_dirty: Dict[ApolloClient, bool] = defaultdict(lambda: True)
         self._release_keys: Dict[ApolloClient, Dict[str, str]] = defaultdict(dict)
+        # messages of the last applied notification per namespace
+        self._last_messages: Dict[ApolloClient, Dict[str, Any]] = defaultdict(dict)
+        # (client, namespace) of collected settings classes, pruned from the loop by _prune
+        self._dead_namespaces: List[Tuple[ApolloClient, str]] = []
+        self._key_cache: WeakKeyDictionary[Type["ApolloSettings"], Dict[str, KeyTransform]] = WeakKeyDictionary()
         self._started: bool = False
-        self._running_fut = None
-        self._started_fut = None
         self._onerror_retry_interval = onerror_retry_interval
         self._onerror_resume = onerror_resume
+        self._max_concurrent_fetches = max_concurrent_fetches
+        self._fetch_semaphore: Optional[asyncio.Semaphore] = None
+        self._poll_tasks: Set[asyncio.Task] = set()
+        # pydantic re-validation runs here, off the event loop; one worker keeps updates serialized
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='apollo_pydantic')
+        # created lazily in the running loop, pooled connections can't outlive their event loop
+        self._http_client: Optional[httpx.AsyncClient] = None
+        self._http_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @staticmethod
+    def _new_http_client():
+        # one keep-alive pool shared by every ApolloClient, long-poll and config fetches reuse sockets
+        # timeouts are given per request by ApolloClient
+        return httpx.AsyncClient(http2=True,
+                                 limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=75))
+
+    def _open_http_client(self):
+        loop = asyncio.get_running_loop()
+        if self._http_client is not None and not self._http_client.is_closed and self._http_client_loop is loop:
+            return
+        self._http_client = self._new_http_client()
+        self._http_client_loop = loop
+        for client in self._clients.values():
+            client._client = self._http_client
 
     def _get_key(self, cls: Type["ApolloSettings"]):
-        namespace = cls.__namespace__
-        model_config = cls.model_config
-        key = (
-            model_config.get('config_server'),
-            model_config.get('appid'),
-            model_config.get('cluster'),
-            namespace
-        )
-        return key
+        return cls.__apollo_full_key__
 
     def register(self, cls: Type["ApolloSettings"]):
         key = self._get_key(cls)
@@ -70,28 +158,56 @@ class ApolloSettingsMetadata:
         if key in self._registered and namespace in self._registered.get(key):
             msg = 'config_server=%s appid=%s cluster=%s namespace=%s already defined' % key
             raise ValueError(f'{cls.__name__}:{msg}')
-        client = self._clients.get(key, ApolloClient(*key, secret_key=cls.model_config.get('secret_key')))
+        client = self._clients.get(key) or ApolloClient(*key,
+                                                        secret_key=cls.model_config.get('secret_key'),
+                                                        client=self._http_client)
         if key not in self._clients:
             self._clients[key] = client
         self._registered[client][namespace] = cls
-        self._notifications[client].append({'namespaceName': namespace, 'notificationId': -1})
+        self._client_by_cls[cls] = client
+        self._namespace_by_cls[cls] = namespace
+        self._notifications[client][namespace] = {'namespaceName': namespace, 'notificationId': -1}
+        self._notifications_dirty[client] = True
         self._release_keys[client][namespace] = None
+        # a re-registered namespace must be fetched and validated again for the new class
+        self._last_messages[client].pop(namespace, None)
+        client.forget(namespace)
+        finalize(cls, self._dead_namespaces.append, (client, namespace))
+
+    def _prune(self):
+        while self._dead_namespaces:
+            client, namespace = self._dead_namespaces.pop()
+            if namespace in self._registered[client]:
+                # namespace was registered again by a new class
+                continue
+            self._notifications[client].pop(namespace, None)
+            self._notifications_dirty[client] = True
+            self._release_keys[client].pop(namespace, None)
+            self._last_messages[client].pop(namespace, None)
+            client.forget(namespace)
 
     def _get_client(self, cls: Type["ApolloSettings"]):
-        key = self._get_key(cls)
-        return self._clients.get(key[:-1])
+        return self._client_by_cls.get(cls)
 
     async def _notification_once(self, key: ClientKey, client: ApolloClient):
+        self._prune()
+        if not self._notifications[client]:
+            # every settings class of this client was collected
+            await asyncio.sleep(self._onerror_retry_interval)
+            return key, client
+        if self._notifications_dirty[client]:
+            self._notifications_encoded[client] = client.encode_notifications(list(self._notifications[client].values()))
+            self._notifications_dirty[client] = False
+        res = await client.notification(self._notifications_encoded[client])
+        if not res:
+            return key, client
         notifications = self._notifications[client]
-        async with client:
-            res = await client.notification(notifications)
-            if not res:
-                return key, client
-            for notification in res:
-                for notif in self._notifications[client]:
-                    if notif['namespaceName'] == notification['namespaceName']:
-                        notif['notificationId'] = notification['notificationId']
-            await self._update(client, res)
+        for notification in res:
+            notif = notifications.get(notification['namespaceName'])
+            if notif and notif['notificationId'] != notification['notificationId']:
+                notif['notificationId'] = notification['notificationId']
+                self._notifications_dirty[client] = True
+        await self._update(client, res)
         return key, client
 
     async def _notification_one(self, key: ClientKey, client: ApolloClient, onerror_resume: bool = True):
@@ -109,120 +225,171 @@ class ApolloSettingsMetadata:
             await asyncio.sleep(self._onerror_retry_interval)
         return key, client
 
+    async def _poll_forever(self, key: ClientKey, client: ApolloClient):
+        while self._started:
+            await self._notification_one(key, client, self._onerror_resume)
+
+    async def _fetch_config(self, client: ApolloClient, namespace: str, **kwargs):
+        # cap parallel fetches so a large fan-out doesn't drain the shared connection pool
+        async with self._fetch_semaphore:
+            return await client.uncached_config(namespace, skip_unchanged=True, **kwargs)
+
     async def _update(self, client: ApolloClient, res: Dict[str, Any]):
         if not res:
             return
-        tasks = set()
+        last_messages = self._last_messages[client]
+        pending = []
+        tasks = []
         for notification in res:
             namespace = notification['namespaceName']
-            messages = notification['messages']
-            label = self._registered[client][namespace].model_config.get('label')
-            tasks.add(asyncio.create_task(client.uncached_config(namespace,
-                                                                  messages=messages,
-                                                                  label=label)))
-        result = await asyncio.gather(*tasks)
-        for res in result:
-            if res:
-                self._update_metadata(client, res)
-
-    def _update_metadata(self, client: ApolloClient, res: Dict[str, Any]):
-        if not res:
+            messages = notification.get('messages')
+            if messages and last_messages.get(namespace) == messages:
+                # server reports nothing new for this namespace
+                continue
+            cls = self._registered[client].get(namespace)
+            if cls is None:
+                # settings class was garbage collected
+                continue
+            label = cls.__apollo_label__
+            pending.append((namespace, messages))
+            tasks.append(asyncio.create_task(self._fetch_config(client, namespace,
+                                                                messages=messages,
+                                                                label=label)))
+        result = await asyncio.gather(*tasks, return_exceptions=True)
+        error = None
+        for (namespace, messages), res in zip(pending, result):
+            if isinstance(res, BaseException):
+                error = error or res
+                continue
+            if res is None:
+                continue
+            await self._update_metadata(client, res)
+            last_messages[namespace] = messages
+        if error:
+            raise error
+
+    async def _update_metadata(self, client: ApolloClient, res: Dict[str, Any]):
+        if not res or res is UNCHANGED:
             return
         namespace = res['namespaceName']
-        cls = self._registered[client][namespace]
+        cls = self._registered[client].get(namespace)
+        if cls is None:
+            return
         self._release_keys[client][namespace] = res['releaseKey']
-        self._update_instances(cls, res['configurations'])
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._update_instances, cls, res['configurations'])
+        client.mark_applied(namespace)
 
-    @lru_cache
-    def _get_alias(self, cls: Type["ApolloSettings"]):
+    def _get_alias(self, cls: Type["ApolloSettings"]) -> FrozenSet[str]:
+        if cls in self._aliases:
+            return self._aliases[cls]
         aliases = set()
         for field_info in cls.model_fields.values():
             if field_info.alias:
                 _add_alias_to_set(aliases=aliases, alias=field_info.alias)
             if field_info.validation_alias:
                 _add_alias_to_set(aliases=aliases, alias=field_info.validation_alias)
+        aliases = self._aliases[cls] = frozenset(aliases)
         return aliases
 
-    def _update_instances(self, cls: Type["ApolloSettings"], config: Dict[str, str]):
-        prefix = cls.model_config.get('env_prefix') or ''
-        env_nested_delimiter = cls.model_config.get('env_nested_delimiter') or '__'
+    def _transform_key(self, cls: Type["ApolloSettings"], k: str) -> KeyTransform:
+        key = k.replace(".", cls.__env_nested_delimiter__)
+        prefix = cls.__env_prefix__
         aliases = self._get_alias(cls)
-        arr_map = defaultdict(list)
+        if m := ARRAY_RE.fullmatch(key):
+            name, index = m.group('name'), int(m.group('index'))
+            if prefix and name not in aliases:
+                name = f'{prefix}{name}'
+            return name, index
+        if prefix and k not in aliases:
+            key = f'{prefix}{key}'
+        return key, None
+
+    def _update_instances(self, cls: Type["ApolloSettings"], config: Dict[str, str]):
+        key_cache = self._key_cache.setdefault(cls, {})
+        env_vars = {}
+        arr_map = defaultdict(dict)
         for k, v in config.items():
-            key = k.replace(".", env_nested_delimiter)
-            if m := ARRAY_RE.match(key):
-                arr_map[m.group('name')].append((int(m.group('index')), v))
+            if (transform := key_cache.get(k)) is None:
+                transform = key_cache[k] = self._transform_key(cls, k)
+            key, index = transform
+            if index is not None:
+                arr_map[key][index] = v
                 continue
-            if k not in aliases:
-                key = f'{prefix}{key}'
-            os.environ[key] = v
+            env_vars[key] = v
 
         for k, vs in arr_map.items():
-            if k not in aliases:
-                k = f'{prefix}{k}'
-            os.environ[k] = json.dumps([v for _, v in sorted(vs)])
-
-        if cls in ApolloSettings.__instances__:
-            inst = ApolloSettings.__instances__[cls]
-        else:
-            inst = cls()
-            ApolloSettings.__instances__[cls] = inst
+            n = len(vs)
+            if max(vs) == n - 1:
+                # dense arr[0]..arr[n-1], no sort needed
+                values = [vs[i] for i in range(n)]
+            else:
+                values = [vs[i] for i in sorted(vs)]
+            env_vars[k] = json_dumps(values)
+        cls.__apollo_env__ = env_vars
+
+        # returns the singleton, creating it on first update
+        inst = cls()
         inst._init()
 
     async def _update_by_release_key(self, cls: Type["ApolloSettings"]):
-        namespace = cls.__namespace__
+        namespace = self._namespace_by_cls.get(cls)
         if not namespace:
             raise ValueError(f'{cls.__name__}:namespace must be set in model_config')
         client = self._get_client(cls)
         if not client:
             raise ValueError(f'{cls.__name__}:apollo client not found for {namespace}')
+        self._open_http_client()
         release_key = self._release_keys[client][namespace]
-        label = cls.__label__
-        res = await client.uncached_config(namespace, release_key=release_key, label=label)
+        label = cls.__apollo_label__
+        res = await client.uncached_config(namespace, release_key=release_key, label=label, skip_unchanged=True)
         if res:
-            self._update_metadata(client, res)
+            await self._update_metadata(client, res)
 
-    async def _start(self):
+    async def start(self):
         if self._started:
             return
         self._started = True
-        self._running_fut = asyncio.Future()
+        self._fetch_semaphore = asyncio.Semaphore(self._max_concurrent_fetches)
+        self._open_http_client()
         # ensure all instances are initialized
-        init_tasks, _ = await asyncio.wait({asyncio.create_task(self._notification_one(key, client, onerror_resume=False))
-                            for key, client in self._clients.items()})
-        for task in init_tasks:
-            if e := task.exception():
+        results = await asyncio.gather(*(self._notification_one(key, client, onerror_resume=False)
+                                         for key, client in self._clients.items()),
+                                       return_exceptions=True)
+        for e in results:
+            if isinstance(e, BaseException):
                 # instances init failed, raise it
+                self._started = False
                 raise e
-        self._started_fut.set_result(None)
-        tasks = {asyncio.create_task(self._notification_one(key, client, self._onerror_resume))
+        # one long-lived polling task per client, stop() cancels them
+        self._poll_tasks = {asyncio.create_task(self._poll_forever(key, client))
                             for key, client in self._clients.items()}
-        while self._started:
-            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-            for task in done:
-                key, client = await task
-                tasks.add(asyncio.create_task(self._notification_one(key, client, self._onerror_resume)))
-        for task in tasks:
-            task.cancel()
-        await asyncio.gather(*tasks, return_exceptions=True)
-        self._running_fut.set_result(None)
-
-    async def start(self):
-        self._started_fut = asyncio.Future()
-        asyncio.create_task(self._start())
-        await self._started_fut
 
     async def stop(self):
         if not self._started:
             return
         self._started = False
-        await self._running_fut
+        for task in self._poll_tasks:
+            task.cancel()
+        await asyncio.gather(*self._poll_tasks, return_exceptions=True)
+        self._poll_tasks = set()
+        if self._http_client is not None:
+            await self._http_client.aclose()
 
 class ApolloSettings(BaseSettings):
     __metadata__:ApolloSettingsMetadata = ApolloSettingsMetadata()
-    __instances__: Dict[Type["ApolloSettings"], "ApolloSettings"] = {}
+    # field name -> weak refs to the settings classes defining it, in registration order
+    __field_index__: Dict[str, List["ref[Type[ApolloSettings]]"]] = {}
     __namespace__: Optional[str] = None
     __label__: Optional[str] = None
+    # resolved from model_config once per subclass
+    __apollo_key__: Optional[ClientKey] = None
+    __apollo_full_key__: Optional[Tuple[Union[HttpUrl, str], str, str, str]] = None
+    __apollo_label__: Optional[str] = None
+    __env_prefix__: str = ''
+    __env_nested_delimiter__: str = '__'
+    # latest apollo config of the namespace, keyed by env name, see ApolloEnvSettingsSource
+    __apollo_env__: Dict[str, str] = {}
 
     model_config = ApolloSettingsConfigDict(
         from_attributes=True,
@@ -233,17 +400,55 @@ class ApolloSettings(BaseSettings):
 
     @classmethod
     def __pydantic_init_subclass__(cls, **kwargs):
+        if isinstance(customise := cls.__dict__.get('settings_customise_sources'), classmethod):
+            cls.settings_customise_sources = _with_apollo_source(customise.__func__)
         namespace = cls.__namespace__
         if not namespace:
             return
+        model_config = cls.model_config
+        cls.__apollo_key__ = (
+            model_config.get('config_server'),
+            model_config.get('appid'),
+            model_config.get('cluster'),
+        )
+        cls.__apollo_full_key__ = cls.__apollo_key__ + (namespace,)
+        cls.__apollo_label__ = cls.__label__ or model_config.get('label')
+        cls.__env_prefix__ = model_config.get('env_prefix') or ''
+        cls.__env_nested_delimiter__ = model_config.get('env_nested_delimiter') or '__'
         ApolloSettings.__metadata__.register(cls)
+        cls._index_fields()
+
+    @classmethod
+    def _index_fields(cls):
+        index = ApolloSettings.__field_index__
+        names = list(cls.model_fields)
+
+        def unindex(cls_ref):
+            for name in names:
+                refs = index.get(name)
+                if refs and cls_ref in refs:
+                    refs.remove(cls_ref)
+                    if not refs:
+                        del index[name]
+
+        cls_ref = ref(cls, unindex)
+        for name in names:
+            index.setdefault(name, []).append(cls_ref)
 
     # ensure singleton
     def __new__(cls, **kwargs):
-        if cls not in cls.__instances__:
-            inst = super().__new__(cls)
-            cls.__instances__[cls] = inst
-        return cls.__instances__[cls]
+        # look in the class' own __dict__, a parent's singleton must not be inherited
+        inst = cls.__dict__.get('__apollo_instance__')
+        if inst is not None:
+            return inst
+        # updates create the instance on the executor thread, don't race the loop thread
+        with _instance_lock:
+            inst = cls.__dict__.get('__apollo_instance__')
+            if inst is None:
+                inst = super().__new__(cls)
+                # the singleton lives on its own class, so both can be collected together
+                cls.__apollo_instance__ = inst
+        return inst
 
     def _init(self, **kwargs):
         super().__init__(**kwargs)
@@ -251,6 +456,17 @@ class ApolloSettings(BaseSettings):
     def __init__(self, **kwargs):
         pass
 
+    @classmethod
+    def settings_customise_sources(cls,
+                                   settings_cls: Type[BaseSettings],
+                                   init_settings: PydanticBaseSettingsSource,
+                                   env_settings: PydanticBaseSettingsSource,
+                                   dotenv_settings: PydanticBaseSettingsSource,
+                                   file_secret_settings: PydanticBaseSettingsSource):
+        return _add_apollo_source(settings_cls,
+                                  (init_settings, env_settings, dotenv_settings, file_secret_settings),
+                                  init_settings, env_settings)
+
     @classmethod
     async def start(cls):
         return await cls.__metadata__.start()
@@ -275,7 +491,9 @@ class ApolloSettings(BaseSettings):
 
     @classmethod
     def get(cls, name: str):
-        for c in cls.__instances__.values():
-            fields = c.model_fields
-            if name in fields:
-                return getattr(c, name)
\ No newline at end of file
+        for cls_ref in tuple(cls.__field_index__.get(name, ())):
+            inst_cls = cls_ref()
+            inst = inst_cls.__dict__.get('__apollo_instance__') if inst_cls is not None else None
+            if inst is not None:
+                return getattr(inst, name)
+        return None
\ No newline at end of file